@@ -0,0 +1,299 @@
+import io
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pymupdf
+
+from utils_numba import group_and_tag
+
+# 1ワーカーが一度に担当するページ数（pymupdf.open のコストを償却するため）
+PAGE_BATCH_SIZE = 50
+
+# ワーカー出力の行ID・値IDを全体の通し番号に振り直すためのパターン
+_ID_RE = re.compile(r'\[r_([0-9]+)\]|<v_([0-9]+):')
+
+
+def _page_words(page):
+    """ページ内の語を (tops, x0s, texts) の並列配列として返す"""
+    # get_text("words") は (x0, y0, x1, y1, text, block_no, line_no, word_no) のタプル
+    # MuPDF は座標を単精度で保持しているため、float32 に落としても値は変わらない
+    words = page.get_text("words")
+    n = len(words)
+    tops = np.fromiter((t[1] for t in words), dtype=np.float32, count=n)
+    x0s = np.fromiter((t[0] for t in words), dtype=np.float32, count=n)
+    texts = [t[4] for t in words]
+    return tops, x0s, texts
+
+
+def _page_batches(page_count):
+    """ページを PAGE_BATCH_SIZE ごとの [start, stop) に分割する"""
+    starts = range(0, page_count, PAGE_BATCH_SIZE)
+    stops = [min(s + PAGE_BATCH_SIZE, page_count) for s in starts]
+    return starts, stops
+
+
+def _extract_pages(pdf_bytes, start, stop):
+    """プロセスプールのワーカー。[start, stop) のページの (tops, x0s, texts) を返す"""
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return [_page_words(doc[i]) for i in range(start, stop)]
+
+
+def extract_all_words(pdf_bytes):
+    """
+    PDF の全ページから語を抽出し、ページごとの (tops, x0s, texts) を返す。
+    許容値に依存しないため、UI 側でファイル内容をキーにキャッシュできる。
+    PAGE_BATCH_SIZE を超える文書はバッチに分割してプロセスプールで並列に抽出する。
+    """
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = doc.page_count
+        if page_count <= PAGE_BATCH_SIZE:
+            return [_page_words(page) for page in doc]
+
+    starts, stops = _page_batches(page_count)
+    n = len(starts)
+    words_per_page = []
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, n)) as executor:
+        for batch in executor.map(_extract_pages, [pdf_bytes] * n, starts, stops):
+            words_per_page.extend(batch)
+    return words_per_page
+
+
+def _process_pages(pdf_bytes, start, stop, x_tolerance, y_tolerance, mask_numbers):
+    """
+    プロセスプールのワーカー。[start, stop) のページを解析し、
+    ローカルなカウンターで採番した結果と、その使用数を返す。
+    """
+    streamer = UniversalFinancialStreamer(x_tolerance, y_tolerance, mask_numbers)
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pages = list(streamer._stream_pages(doc, start, stop))
+    return pages, streamer.row_counter, streamer.val_counter
+
+
+class UniversalFinancialStreamer:
+    # 数値（カンマ、小数点、前置の△▲、後続の%を含む）を抽出する正規表現
+    # 兆、億、万などの漢字単位はあえてAIに解釈させるため抽出対象から外す（外側に残す）
+    _NUM_RE = re.compile(r'[△▲-]?[0-9０-９,，.．]+%?')
+    # _NUM_RE がマッチするには、このいずれかの文字が必ず含まれる
+    _NUM_CHAR_SET = frozenset("0123456789０１２３４５６７８９,，.．")
+    # 半角・全角数字と、数値候補とみなす通貨・計算記号
+    _DIGIT_SET = frozenset("0123456789０１２３４５６７８９")
+    _SYM_SET = frozenset("△▲¥$€%.,")
+    # マスキング用の変換テーブル（数字 -> 'x'）
+    _MASK_TABLE = str.maketrans({c: 'x' for c in _DIGIT_SET})
+    # 計算の邪魔になる半角・全角カンマの除去テーブル
+    _COMMA_TABLE = str.maketrans({',': None, '，': None})
+    # _normalize_text 用（半角カンマのみ除去）
+    _NORM_TABLE = str.maketrans({',': None})
+    # x 座標のゼロ埋め文字列（語ごとの書式指定 :03d の解釈を表引きに置き換える）
+    _X_STR = [f"{i:03d}" for i in range(2000)]
+    # ページ内のトークンを連結する区切り文字（_NUM_RE にはマッチしない制御文字）
+    _TOKEN_SEP = "\x1f"
+
+    def __init__(self, x_tolerance=20, y_tolerance=11, mask_numbers=False):
+        self.x_tolerance = x_tolerance
+        self.y_tolerance = y_tolerance
+        self.mask_numbers = mask_numbers  # 数値を隠すかどうかのフラグ
+        # トークンごとの分岐をなくすため、フラグに応じた実装を初期化時に束縛する
+        if mask_numbers:
+            self._apply_value_id = self._apply_value_id_masked
+        else:
+            self._apply_value_id = self._apply_value_id_plain
+        # 全ページ通してのIDカウンター
+        self.row_counter = 0
+        self.val_counter = 0
+
+    def process_pdf(self, pdf_file):
+        return self._format_output(self.iter_pages(pdf_file))
+
+    def process_words(self, words_per_page):
+        """extract_all_words の結果から出力を生成する（PDF の再解析なし）"""
+        return self._format_output(self.iter_words(words_per_page))
+
+    def iter_pages(self, pdf_file):
+        """
+        ページごとに (page_idx, page_stream, baselines) を順に返すジェネレーター。
+        文書全体の文字列を保持しないため、ピークメモリはページ単位で済む。
+        """
+        self.row_counter = 0  # 処理開始時にリセット
+        self.val_counter = 0
+        pdf_bytes = pdf_file.read()
+        with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+            page_count = doc.page_count
+            if page_count <= PAGE_BATCH_SIZE:
+                yield from self._stream_pages(doc, 0, page_count)
+                return
+        yield from self._stream_pages_parallel(pdf_bytes, page_count)
+
+    def iter_words(self, words_per_page):
+        """iter_pages と同じ形式で、extract_all_words の結果からページごとに返す"""
+        self.row_counter = 0  # 処理開始時にリセット
+        self.val_counter = 0
+        yield from self._stream_words(words_per_page)
+
+    @staticmethod
+    def format_page(page_idx, page_stream, baselines):
+        return f"{UniversalFinancialStreamer._page_header(page_idx, baselines)}\n{page_stream}"
+
+    @staticmethod
+    def _page_header(page_idx, baselines):
+        # StreamlitのUI側に情報を付与
+        return f"=== PAGE {page_idx+1} [Detected {len(baselines)} Columns] ==="
+
+    def _format_output(self, pages):
+        # ページごとの連結文字列を作らず、1つのバッファへ順に書き込んで最後に一度だけ取り出す
+        buf = io.StringIO()
+        for n, (i, page_stream, baselines) in enumerate(pages):
+            if n:
+                buf.write("\n\n")
+            buf.write(self._page_header(i, baselines))
+            buf.write("\n")
+            buf.write(page_stream)
+        return buf.getvalue()
+
+    def _stream_pages(self, doc, start, stop):
+        pages = (_page_words(doc[i]) for i in range(start, stop))
+        return self._stream_words(pages, start)
+
+    def _stream_words(self, words_per_page, start=0):
+        # words は (tops, x0s, texts)。語のないページは飛ばす
+        for i, words in enumerate(words_per_page, start):
+            if not words[2]:
+                continue
+
+            rows, col_indices, baselines = self._layout_page(words)
+            yield i, self._format_rows(words, rows, col_indices), baselines
+
+    def _stream_pages_parallel(self, pdf_bytes, page_count):
+        """ページをバッチに分割してプロセスプールで並列解析し、IDを通し番号に振り直して順に返す"""
+        starts, stops = _page_batches(page_count)
+        n = len(starts)
+
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, n)) as executor:
+            results = executor.map(
+                _process_pages,
+                [pdf_bytes] * n, starts, stops,
+                [self.x_tolerance] * n, [self.y_tolerance] * n, [self.mask_numbers] * n,
+            )
+            for batch, rows, vals in results:
+                row_offset, val_offset = self.row_counter, self.val_counter
+
+                def renumber(match):
+                    if match.group(1) is not None:
+                        return f"[r_{int(match.group(1)) + row_offset:03d}]"
+                    return f"<v_{int(match.group(2)) + val_offset:03d}:"
+
+                self.row_counter += rows
+                self.val_counter += vals
+                for i, page_stream, baselines in batch:
+                    yield i, _ID_RE.sub(renumber, page_stream), baselines
+
+    def _layout_page(self, words):
+        """ページ内の語を行・列に割り当てる。(rows, col_indices, col_baselines) を返す"""
+        tops, x0s, texts = words
+        # 1. Y軸（行）でグルーピング
+        # (top, x0) の並列配列から lexsort で並び順を求める
+        order = np.lexsort((x0s, tops))
+
+        x0s_sorted = x0s[order]
+
+        # 2. 行・列の判定は Numba でコンパイルしたループで一括処理
+        row_ids, col_sorted, baselines = group_and_tag(
+            tops[order], x0s_sorted, float(self.y_tolerance), float(self.x_tolerance)
+        )
+        col_baselines = baselines.tolist()
+        col_indices = np.empty(len(texts), dtype=np.int64)
+        col_indices[order] = col_sorted
+        col_indices = col_indices.tolist()
+
+        # 各行はページ内の語へのインデックスのリスト（x0 順）
+        # 同じ行でも top は揺れるため (top, x0) 順は行内の x0 順ではない。行ごとに並べ直す代わりに
+        # (row_id, x0) で一度だけ lexsort し、行の境界で分割する
+        row_order = order[np.lexsort((x0s_sorted, row_ids))]
+        rows = [row.tolist() for row in np.split(row_order, np.flatnonzero(np.diff(row_ids)) + 1)]
+
+        return rows, col_indices, col_baselines
+
+    def _format_rows(self, words, rows, col_indices):
+        # 3. ストリーム形式に変換
+        _, x0s, texts = words
+        x_ints = x0s.astype(np.int64).tolist()  # int() と同じく 0 方向への切り捨て
+        x_str = self._X_STR
+        n_x = len(x_str)
+        # 数値候補かどうか判定してIDを振る（ページ内の全トークンを一括処理）
+        tagged_texts = iter(self._apply_value_ids([texts[j] for row in rows for j in row]))
+        lines = []
+        for row in rows:
+            self.row_counter += 1
+            row_id = f"[r_{self.row_counter:03d}]"
+            base_x = x_ints[row[0]]
+            # 文字列の連結を繰り返さず、部品をリストに溜めて最後に一度だけ join する
+            parts = [f"{row_id}<x:{base_x:03d}> "]
+            
+            for j in row:
+                col_idx = col_indices[j]
+                xi = x_ints[j]
+                xs = x_str[xi] if 0 <= xi < n_x else f"{xi:03d}"
+                tagged_text = next(tagged_texts)
+                
+                parts.append(f"<col:{col_idx}, x:{xs}> {tagged_text} ")
+            lines.append("".join(parts))
+
+        return "\n".join(lines)
+
+    # --- 【新規・変更点】数値可能性の最大抽出ロジック ---
+    def _is_numeric_candidate(self, text):
+        """数字（全角・半角）または特定の通貨・計算記号が含まれているか判定"""
+        return not self._DIGIT_SET.isdisjoint(text) or not self._SYM_SET.isdisjoint(text)
+
+    def _mask_text(self, text):
+        """数値を 'x' に置換しつつ、単位や記号（兆、円、％、△等）を保護する"""
+        # 半角・全角数字をすべて 'x' に置換
+        return text.translate(self._MASK_TABLE)
+    
+    def _apply_value_id_plain(self, text):
+        """
+        トークン内の数値部分(2,589)だけを見つけ出し、
+        ID化(<v_001:2589>)して、前後の文字(億円となり、)はそのまま残す。
+        """
+        comma_table = self._COMMA_TABLE
+
+        def replace_match(match):
+            self.val_counter += 1
+            # 計算の邪魔になるカンマを消去
+            return f"<v_{self.val_counter:03d}:{match.group(0).translate(comma_table)}>"
+
+        # テキスト内の数値部分だけを置換
+        return self._NUM_RE.sub(replace_match, text)
+
+    def _apply_value_id_masked(self, text):
+        """_apply_value_id_plain のマスキング版。数値部分のみを x に置換する（<v_001:xxxx>）"""
+        comma_table = self._COMMA_TABLE
+        mask_table = self._MASK_TABLE
+
+        def replace_match(match):
+            self.val_counter += 1
+            return f"<v_{self.val_counter:03d}:{match.group(0).translate(comma_table).translate(mask_table)}>"
+
+        return self._NUM_RE.sub(replace_match, text)
+
+    def _apply_value_ids(self, texts):
+        """
+        複数トークンを区切り文字で連結し、_apply_value_id を1回の正規表現パスで適用する。
+        数値パターンは区切り文字をまたがないため、結果はトークンごとの適用と同じになる。
+        """
+        joined = self._TOKEN_SEP.join(texts)
+        if joined.count(self._TOKEN_SEP) != len(texts) - 1:
+            # トークン自体に区切り文字が含まれている場合は個別に処理する
+            # （数値になり得る文字を含まないトークンは正規表現にかけない）
+            return [
+                t if self._NUM_CHAR_SET.isdisjoint(t) else self._apply_value_id(t)
+                for t in texts
+            ]
+        return self._apply_value_id(joined).split(self._TOKEN_SEP)
+
+    # _normalize_text は _apply_value_id 内に統合されたため廃止可能ですが、
+    # 互換性のため、あるいはシンプルな前処理が必要な場合のために最小限で残します。
+    def _normalize_text(self, text):
+        return text.translate(self._NORM_TABLE)
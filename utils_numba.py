@@ -0,0 +1,48 @@
+import numpy as np
+from numba import float32, float64, njit
+
+
+@njit((float32[:], float32[:], float64, float64), cache=True)
+def group_and_tag(tops, x0s, y_tol, x_tol):
+    """
+    (top, x0) 順にソート済みの座標配列から、行番号・列番号・列の基準線を一括で求める。
+
+    - 行: 行の先頭語から y_tol 以内の語を同じ行とする
+    - 基準線: x0 を昇順に走査し、直前の基準線から x_tol を超えたら新しい列とする
+    - 列番号: x_tol 以内にある最初の基準線の番号（1始まり）。該当なしは 1
+
+    座標は float32 で受け取るが、許容値との差・和は float64 で計算する
+    （float32 で丸めると境界付近の判定が変わるため）。
+    """
+    n = len(tops)
+
+    # 1. 行番号
+    row_ids = np.empty(n, dtype=np.int64)
+    r = 0
+    last_y = np.float64(tops[0])
+    for i in range(n):
+        y = np.float64(tops[i])
+        if abs(y - last_y) > y_tol:
+            r += 1
+            last_y = y
+        row_ids[i] = r
+
+    # 2. 列の基準線
+    xs = np.sort(x0s)
+    baselines = np.empty(n, dtype=np.float32)
+    k = 0
+    for x in xs:
+        if k == 0 or np.float64(x) > np.float64(baselines[k - 1]) + x_tol:
+            baselines[k] = x
+            k += 1
+    baselines = baselines[:k]
+
+    # 3. 列番号（基準線はソート済みなので、x - tol 以上となる最初の基準線だけを判定すればよい）
+    col_indices = np.ones(n, dtype=np.int64)
+    for i in range(n):
+        x = np.float64(x0s[i])
+        j = np.searchsorted(baselines, x - x_tol)
+        if j < k and abs(x - np.float64(baselines[j])) <= x_tol:
+            col_indices[i] = j + 1
+
+    return row_ids, col_indices, baselines